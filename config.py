@@ -1,11 +1,11 @@
 import os
 
 
-def try_parse(type, value: str):
+def try_parse(type, value: str, default=None):
     try:
         return type(value)
     except Exception:
-        return None
+        return default
 
 
 # Configuration for POSTGRES
@@ -14,4 +14,11 @@ POSTGRES_PORT = try_parse(int, os.environ.get("POSTGRES_PORT")) or 5432
 POSTGRES_USER = os.environ.get("POSTGRES_USER") or "user"
 POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASS") or "pass"
 POSTGRES_DB = os.environ.get("POSTGRES_DB") or "test_db"
-DATABASE_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
\ No newline at end of file
+POSTGRES_CREATE_TABLES = (os.environ.get("POSTGRES_CREATE_TABLES") or "true").lower() != "false"
+DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+# Configuration for the database connection pool
+POSTGRES_POOL_SIZE = try_parse(int, os.environ.get("POSTGRES_POOL_SIZE"), 20)
+POSTGRES_MAX_OVERFLOW = try_parse(int, os.environ.get("POSTGRES_MAX_OVERFLOW"), 40)
+POSTGRES_POOL_TIMEOUT = try_parse(float, os.environ.get("POSTGRES_POOL_TIMEOUT"), 2.0)
+POSTGRES_POOL_RECYCLE = try_parse(int, os.environ.get("POSTGRES_POOL_RECYCLE"), 3600)
\ No newline at end of file
@@ -0,0 +1,34 @@
+-- Brings a processed_agent_data table created before the (user_id, timestamp)
+-- unique constraint up to the current schema. Safe to run more than once.
+BEGIN;
+
+-- Keep the earliest row of every duplicated reading
+DELETE FROM processed_agent_data a
+USING processed_agent_data b
+WHERE a.user_id = b.user_id
+  AND a.timestamp = b.timestamp
+  AND a.id > b.id;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conname = 'processed_agent_data_user_id_timestamp_key'
+    ) THEN
+        ALTER TABLE processed_agent_data
+            ADD CONSTRAINT processed_agent_data_user_id_timestamp_key UNIQUE (user_id, timestamp);
+    END IF;
+END $$;
+
+-- Indexes created by earlier versions of the model that nothing reads any more
+DROP INDEX IF EXISTS ix_processed_agent_data_id;
+DROP INDEX IF EXISTS ix_processed_agent_data_road_state;
+DROP INDEX IF EXISTS ix_processed_agent_data_user_id;
+DROP INDEX IF EXISTS ix_processed_agent_data_x;
+DROP INDEX IF EXISTS ix_processed_agent_data_y;
+DROP INDEX IF EXISTS ix_processed_agent_data_z;
+DROP INDEX IF EXISTS ix_processed_agent_data_latitude;
+DROP INDEX IF EXISTS ix_processed_agent_data_longitude;
+DROP INDEX IF EXISTS ix_processed_agent_data_timestamp;
+
+COMMIT;
\ No newline at end of file
@@ -7,5 +7,6 @@ CREATE TABLE IF NOT EXISTS processed_agent_data (
     z FLOAT,
     latitude FLOAT,
     longitude FLOAT,
-    timestamp TIMESTAMP
+    timestamp TIMESTAMP,
+    UNIQUE (user_id, timestamp)
 );
\ No newline at end of file
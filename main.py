@@ -1,19 +1,37 @@
-import json
-from typing import Set, Dict, List
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends
+import asyncio
+import orjson
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Set, DefaultDict, List, Optional
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from sqlalchemy import (
-    create_engine,
     MetaData,
     Integer,
     String,
     Float,
     DateTime,
+    UniqueConstraint,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_scoped_session,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.sql import bindparam, select, update
+from datetime import datetime, timezone
+from pydantic import BaseModel
+from config import (
+    DATABASE_URL,
+    POSTGRES_POOL_SIZE,
+    POSTGRES_MAX_OVERFLOW,
+    POSTGRES_POOL_TIMEOUT,
+    POSTGRES_POOL_RECYCLE,
+    POSTGRES_CREATE_TABLES,
 )
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.sql import select
-from datetime import datetime
-from pydantic import BaseModel, field_validator
-from config import DATABASE_URL
 from sqlalchemy import DateTime, Integer, String
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
@@ -23,30 +41,56 @@ class Base(DeclarativeBase):
 
 class ProcessedAgentDataDB(Base):
     __tablename__ = "processed_agent_data"
+    __table_args__ = (UniqueConstraint("user_id", "timestamp"),)
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
-    road_state: Mapped[str] = mapped_column(String, index=True)
-    user_id: Mapped[int] = mapped_column(Integer, index=True)
-    x: Mapped[float] = mapped_column(Float, index=True)
-    y: Mapped[float] = mapped_column(Float, index=True)
-    z: Mapped[float] = mapped_column(Float, index=True)
-    latitude: Mapped[float] = mapped_column(Float, index=True)
-    longitude: Mapped[float] = mapped_column(Float, index=True)
-    timestamp: Mapped[datetime] = mapped_column(DateTime, index=True)
-
-# FastAPI app setup
-app = FastAPI()
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    road_state: Mapped[str] = mapped_column(String)
+    user_id: Mapped[int] = mapped_column(Integer)
+    x: Mapped[float] = mapped_column(Float)
+    y: Mapped[float] = mapped_column(Float)
+    z: Mapped[float] = mapped_column(Float)
+    latitude: Mapped[float] = mapped_column(Float)
+    longitude: Mapped[float] = mapped_column(Float)
+    timestamp: Mapped[datetime] = mapped_column(DateTime)
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base.metadata.create_all(bind=engine)
+# Database setup
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=POSTGRES_POOL_SIZE,
+    max_overflow=POSTGRES_MAX_OVERFLOW,
+    pool_timeout=POSTGRES_POOL_TIMEOUT,
+    pool_recycle=POSTGRES_POOL_RECYCLE,
+    pool_pre_ping=True,
+)
+# Committed instances keep their loaded state, so reading them after commit
+# does not issue a reload SELECT (an AsyncSession cannot lazily reload)
+SessionLocal = async_scoped_session(
+    async_sessionmaker(engine, autoflush=False, expire_on_commit=False),
+    scopefunc=asyncio.current_task,
+)
 metadata = MetaData()
 
 
-def get_database():
-    database = SessionLocal()
-    yield database
-    database.close()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create missing tables once per worker; skip when the schema is managed externally
+    if POSTGRES_CREATE_TABLES:
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+    yield
+    await engine.dispose()
+
+
+# FastAPI app setup
+app = FastAPI(lifespan=lifespan)
+
+
+async def get_database():
+    # One session per request task, closed and released back to the pool on exit
+    try:
+        yield SessionLocal()
+    finally:
+        await SessionLocal.remove()
 
 
 # FastAPI models
@@ -67,176 +111,298 @@ class AgentData(BaseModel):
     gps: GpsData
     timestamp: datetime
 
-    @classmethod
-    @field_validator("timestamp", mode="before")
-    def check_timestamp(cls, value):
-        if isinstance(value, datetime):
-            return value
-        try:
-            return datetime.fromisoformat(value)
-        except (TypeError, ValueError):
-            raise ValueError(
-                "Invalid timestamp format. Expected ISO 8601 format (YYYY-MM-DDTHH:MM:SSZ)."
-            )
-
 
 class ProcessedAgentData(BaseModel):
     road_state: str
     agent_data: AgentData
 
 
+# Build the ProcessedAgentData response shape straight from a database row
+def processed_agent_data_to_dict(db_item) -> dict:
+    return {
+        "road_state": db_item.road_state,
+        "agent_data": {
+            "user_id": db_item.user_id,
+            "accelerometer": {"x": db_item.x, "y": db_item.y, "z": db_item.z},
+            "gps": {"latitude": db_item.latitude, "longitude": db_item.longitude},
+            "timestamp": db_item.timestamp,
+        },
+    }
+
+
+# The timestamp column has no time zone; store aware values as UTC
+def to_db_timestamp(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 # WebSocket subscriptions
-subscriptions: Dict[int, Set[WebSocket]] = {}
+subscriptions: DefaultDict[int, Set[WebSocket]] = defaultdict(set)
+
+
+def unsubscribe(user_id: int, websocket: WebSocket):
+    websockets = subscriptions.get(user_id)
+    if websockets is None:
+        return
+    websockets.discard(websocket)
+    # Forget users without subscribers so the mapping does not grow unbounded
+    if not websockets:
+        del subscriptions[user_id]
 
 
 # FastAPI WebSocket endpoint
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
     await websocket.accept()
-    if user_id not in subscriptions:
-        subscriptions[user_id] = set()
     subscriptions[user_id].add(websocket)
     try:
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        subscriptions[user_id].remove(websocket)
+        pass
+    finally:
+        unsubscribe(user_id, websocket)
 
 
 # Function to send data to subscribed users
-async def send_data_to_subscribers(user_id: int, data):
+async def send_data_to_subscribers(user_id: int, data: ProcessedAgentData):
     if user_id in subscriptions:
-        for websocket in subscriptions[user_id]:
-            await websocket.send_json(json.dumps(data))
+        # Iterate over a snapshot, the set may change while sends are awaited
+        websockets = tuple(subscriptions[user_id])
+        # Serialize once, every subscriber receives the same payload
+        payload = data.model_dump_json()
+        results = await asyncio.gather(
+            *(websocket.send_text(payload) for websocket in websockets),
+            return_exceptions=True,
+        )
+        # Drop subscribers whose socket failed so they are not retried
+        for websocket, result in zip(websockets, results):
+            if isinstance(result, Exception):
+                unsubscribe(user_id, websocket)
 
 
 # FastAPI CRUDL endpoints
 # POST request
 @app.post("/processed_agent_data/")
 async def create_processed_agent_data(
-    data: List[ProcessedAgentData], database: Session = Depends(get_database)
+    data: List[ProcessedAgentData], database: AsyncSession = Depends(get_database)
 ):
     # Insert data to database
-    # Send data to subscribers
+    rows = [
+        {
+            "road_state": item.road_state,
+            "user_id": item.agent_data.user_id,
+            "x": item.agent_data.accelerometer.x,
+            "y": item.agent_data.accelerometer.y,
+            "z": item.agent_data.accelerometer.z,
+            "latitude": item.agent_data.gps.latitude,
+            "longitude": item.agent_data.gps.longitude,
+            "timestamp": to_db_timestamp(item.agent_data.timestamp),
+        }
+        for item in data
+    ]
+    if not rows:
+        return
+    # Retried readings (same user and timestamp) are skipped instead of duplicated
+    stmt = (
+        pg_insert(ProcessedAgentDataDB)
+        .on_conflict_do_nothing(index_elements=["user_id", "timestamp"])
+        .returning(ProcessedAgentDataDB.user_id, ProcessedAgentDataDB.timestamp)
+    )
+    inserted = set((await database.execute(stmt, rows)).tuples())
+    await database.commit()
+
+    # Send only newly stored data to subscribers
+    new_items = []
     for item in data:
-        db_item = ProcessedAgentDataDB(
-            road_state=item.road_state,
-            user_id=item.agent_data.user_id,
-            x=item.agent_data.accelerometer.x,
-            y=item.agent_data.accelerometer.y,
-            z=item.agent_data.accelerometer.z,
-            latitude=item.agent_data.gps.latitude,
-            longitude=item.agent_data.gps.longitude,
-            timestamp=item.agent_data.timestamp,
-        )
-        database.add(db_item)
-        database.commit()
-        database.refresh(db_item)
-        await send_data_to_subscribers(item.agent_data.user_id, item)
+        key = (item.agent_data.user_id, to_db_timestamp(item.agent_data.timestamp))
+        if key in inserted:
+            inserted.discard(key)
+            new_items.append(item)
+    await asyncio.gather(
+        *(send_data_to_subscribers(item.agent_data.user_id, item) for item in new_items)
+    )
 
 #GET BY ID request
 @app.get("/processed_agent_data/{processed_agent_data_id}", 
          response_model=ProcessedAgentData,)
-def read_processed_agent_data(
+async def read_processed_agent_data(
     processed_agent_data_id: int,
-    database: Session = Depends(get_database),
+    database: AsyncSession = Depends(get_database),
 ):
     # Get data by id
-    db_data = database.query(ProcessedAgentDataDB).filter(ProcessedAgentDataDB.id == processed_agent_data_id).first()
+    db_data = await database.get(ProcessedAgentDataDB, processed_agent_data_id)
+    if db_data is None:
+        raise HTTPException(status_code=404, detail="Processed agent data not found")
         
-    # Constructing the ProcessedAgentData model response
-    agent_data = AgentData(
-        user_id=db_data.user_id,
-        accelerometer=AccelerometerData(x=db_data.x, y=db_data.y, z=db_data.z),
-        gps=GpsData(latitude=db_data.latitude, longitude=db_data.longitude),
-        timestamp=db_data.timestamp
+    # Rows come straight from the database, so skip re-validating them
+    return ORJSONResponse(processed_agent_data_to_dict(db_data))
+
+# Statements for the listing endpoints, built once with bound parameters so
+# requests reuse the same cached compiled SQL instead of rebuilding it
+SELECT_PROCESSED_AGENT_DATA = select(
+    ProcessedAgentDataDB.road_state,
+    ProcessedAgentDataDB.user_id,
+    ProcessedAgentDataDB.x,
+    ProcessedAgentDataDB.y,
+    ProcessedAgentDataDB.z,
+    ProcessedAgentDataDB.latitude,
+    ProcessedAgentDataDB.longitude,
+    ProcessedAgentDataDB.timestamp,
+).execution_options(yield_per=500)
+LIST_PROCESSED_AGENT_DATA = (
+    SELECT_PROCESSED_AGENT_DATA.order_by(ProcessedAgentDataDB.id)
+    .limit(bindparam("limit"))
+    .offset(bindparam("offset"))
+)
+LIST_USER_PROCESSED_AGENT_DATA = (
+    SELECT_PROCESSED_AGENT_DATA.where(ProcessedAgentDataDB.user_id == bindparam("user_id"))
+    .order_by(ProcessedAgentDataDB.timestamp.desc())
+    .limit(bindparam("limit"))
+)
+LIST_USER_PROCESSED_AGENT_DATA_BEFORE = LIST_USER_PROCESSED_AGENT_DATA.where(
+    ProcessedAgentDataDB.timestamp < bindparam("before")
+)
+
+
+# Encode the rows of an already executed result as a JSON array, one row at a time
+async def encode_processed_agent_data(connection, result):
+    try:
+        yield b"["
+        separator = b""
+        # Rows come straight from the database, so skip re-validating them;
+        # unpack the plain column tuples positionally instead of by attribute
+        async for road_state, user_id, x, y, z, latitude, longitude, timestamp in result:
+            yield separator + orjson.dumps(
+                {
+                    "road_state": road_state,
+                    "agent_data": {
+                        "user_id": user_id,
+                        "accelerometer": {"x": x, "y": y, "z": z},
+                        "gps": {"latitude": latitude, "longitude": longitude},
+                        "timestamp": timestamp,
+                    },
+                }
+            )
+            separator = b","
+        yield b"]"
+    finally:
+        await connection.close()
+
+
+# Run the statement before the response starts, so database errors surface
+# as a 500 instead of a 200 with an empty or truncated body
+async def processed_agent_data_stream_response(stmt, parameters: dict) -> StreamingResponse:
+    # Use a dedicated connection: the response body is sent after the
+    # request's dependencies (and their session) have been torn down
+    connection = await engine.connect()
+    try:
+        result = await connection.stream(stmt, parameters)
+    except BaseException:
+        await connection.close()
+        raise
+    return StreamingResponse(
+        encode_processed_agent_data(connection, result), media_type="application/json"
     )
-    processed_data = ProcessedAgentData(road_state=db_data.road_state, agent_data=agent_data)
-    
-    return processed_data
+
 
 #GET ALL
 @app.get("/processed_agent_data/", response_model=list[ProcessedAgentData])
-def list_processed_agent_data(database: Session = Depends(get_database)):
-    # Get list of data
-    db_data = database.query(ProcessedAgentDataDB).all()
-    processed_data = []
-    for db_item in db_data:
-        agent_data = AgentData(
-            user_id=db_item.user_id,
-            accelerometer=AccelerometerData(x=db_item.x, y=db_item.y, z=db_item.z),
-            gps=GpsData(latitude=db_item.latitude, longitude=db_item.longitude),
-            timestamp=db_item.timestamp
-        )
-        processed_data.append(ProcessedAgentData(road_state=db_item.road_state, agent_data=agent_data))
-    
-    return processed_data
+async def list_processed_agent_data(
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    # Get a page of data, selecting only the columns the response needs
+    return await processed_agent_data_stream_response(
+        LIST_PROCESSED_AGENT_DATA, {"limit": limit, "offset": offset}
+    )
+
+#GET readings of one user, newest first
+@app.get("/users/{user_id}/processed_agent_data/", response_model=list[ProcessedAgentData])
+async def list_user_processed_agent_data(
+    user_id: int,
+    before: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+):
+    # Keyset pagination: pass the timestamp of the last reading received as
+    # `before` to get the next page. (user_id, timestamp) is unique, so the
+    # timestamp alone is a stable cursor served by the unique index
+    if before is None:
+        stmt = LIST_USER_PROCESSED_AGENT_DATA
+        parameters = {"user_id": user_id, "limit": limit}
+    else:
+        stmt = LIST_USER_PROCESSED_AGENT_DATA_BEFORE
+        parameters = {"user_id": user_id, "limit": limit, "before": to_db_timestamp(before)}
+    return await processed_agent_data_stream_response(stmt, parameters)
 
 #PUT data
 @app.put(
     "/processed_agent_data/{processed_agent_data_id}",
     response_model=ProcessedAgentData,
 )
-def update_processed_agent_data(
+async def update_processed_agent_data(
     processed_agent_data_id: int,
     data: ProcessedAgentData,
-    database: Session = Depends(get_database),
+    database: AsyncSession = Depends(get_database),
 ):
-    # Update data
-    db_data = database.query(ProcessedAgentDataDB).filter(ProcessedAgentDataDB.id == processed_agent_data_id).first()
-    if db_data is None:
+    # Store and echo the timestamp the way the column holds it (naive UTC)
+    data.agent_data.timestamp = to_db_timestamp(data.agent_data.timestamp)
+
+    # Update the fields with new data in a single statement
+    stmt = (
+        update(ProcessedAgentDataDB)
+        .where(ProcessedAgentDataDB.id == processed_agent_data_id)
+        .values(
+            road_state=data.road_state,
+            user_id=data.agent_data.user_id,
+            x=data.agent_data.accelerometer.x,
+            y=data.agent_data.accelerometer.y,
+            z=data.agent_data.accelerometer.z,
+            latitude=data.agent_data.gps.latitude,
+            longitude=data.agent_data.gps.longitude,
+            timestamp=data.agent_data.timestamp,
+        )
+        .returning(ProcessedAgentDataDB.id)
+        .execution_options(synchronize_session=False)
+    )
+    try:
+        updated_id = (await database.execute(stmt)).scalar_one_or_none()
+    except IntegrityError:
+        # Another row already holds this user's reading at that timestamp
+        await database.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail="Processed agent data for this user and timestamp already exists",
+        )
+    if updated_id is None:
         raise HTTPException(status_code=404, detail="Processed agent data not found")
     
-    # Update the fields with new data
-    db_data.road_state = data.road_state
-    db_data.user_id = data.agent_data.user_id
-    db_data.x = data.agent_data.accelerometer.x
-    db_data.y = data.agent_data.accelerometer.y
-    db_data.z = data.agent_data.accelerometer.z
-    db_data.latitude = data.agent_data.gps.latitude
-    db_data.longitude = data.agent_data.gps.longitude
-    db_data.timestamp = data.agent_data.timestamp
-    
     # Commit the changes to the database
-    database.commit()
+    await database.commit()
     
-    # Constructing the ProcessedAgentData model response
-    agent_data = AgentData(
-        user_id=db_data.user_id,
-        accelerometer=AccelerometerData(x=db_data.x, y=db_data.y, z=db_data.z),
-        gps=GpsData(latitude=db_data.latitude, longitude=db_data.longitude),
-        timestamp=db_data.timestamp
-    )
-    processed_data = ProcessedAgentData(road_state=db_data.road_state, agent_data=agent_data)
-    
-    return processed_data
+    # The stored row now holds exactly the already validated request data
+    return data
 
 #DELETE FROM AgentData
 @app.delete(
     "/processed_agent_data/{processed_agent_data_id}",
     response_model=ProcessedAgentData,
 )
-def delete_processed_agent_data(
+async def delete_processed_agent_data(
     processed_agent_data_id: int,
-    database: Session = Depends(get_database),
+    database: AsyncSession = Depends(get_database),
 ):
     # Delete by id
-    db_data = database.query(ProcessedAgentDataDB).filter(ProcessedAgentDataDB.id == processed_agent_data_id).first()
+    db_data = await database.get(ProcessedAgentDataDB, processed_agent_data_id)
     if db_data is None:
         raise HTTPException(status_code=404, detail="Processed agent data not found")
-    database.delete(db_data)
-    database.commit()
-    
-    # Constructing the ProcessedAgentData model response for the deleted data
-    agent_data = AgentData(
-        user_id=db_data.user_id,
-        accelerometer=AccelerometerData(x=db_data.x, y=db_data.y, z=db_data.z),
-        gps=GpsData(latitude=db_data.latitude, longitude=db_data.longitude),
-        timestamp=db_data.timestamp
-    )
-    processed_data = ProcessedAgentData(road_state=db_data.road_state, agent_data=agent_data)
+    # Snapshot the response for the deleted data before the instance is deleted
+    processed_data = processed_agent_data_to_dict(db_data)
+    await database.delete(db_data)
+    await database.commit()
     
-    return processed_data
+    return ORJSONResponse(processed_data)
 
 if __name__ == "__main__":
     import uvicorn